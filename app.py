@@ -1,11 +1,30 @@
 import streamlit as st
-import google.generativeai as genai
+import hashlib
 import json
+import logging
+import re
 import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+import zlib
 import requests
+from requests.adapters import HTTPAdapter
 import io
+from collections import OrderedDict, deque
+from contextlib import closing
 from fpdf import FPDF
-import PyPDF2
+
+try:
+    import orjson # Rust JSON parser, several times faster on large model replies
+    json_loads = orjson.loads
+    def json_dumps(obj): return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj): return json.dumps(obj, sort_keys=True).encode('utf-8')
 
 # ==========================================
 # ⚙️ CONFIGURATION
@@ -17,15 +36,16 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# ⚡ CORE ENGINE: Gemini 2.5 Pro (Best for Reasoning/Legal Analysis)
-ACTIVE_MODEL = "gemini-2.5-pro"
+# ⚡ CORE ENGINE: Gemini 2.5 Flash by default (fast PDF turnaround); Pro is an explicit opt-in for high-stakes reviews
+ACTIVE_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+ENGINE_OPTIONS = list(dict.fromkeys([ACTIVE_MODEL, "gemini-2.5-flash", "gemini-2.5-pro"]))
 
 # 1. CREDENTIALS
 try:
     API_KEY = os.environ.get("GEMINI_API_KEY")
     if not API_KEY:
         API_KEY = st.secrets["GEMINI_API_KEY"]
-except:
+except Exception: # No secrets.toml / missing key (the exception type varies across Streamlit versions)
     API_KEY = None
 
 DISCORD_WEBHOOK = os.environ.get("DISCORD_WEBHOOK_URL")
@@ -82,9 +102,65 @@ SCHEMA_DEF = """
 }
 """
 
+# 3. Schema Accessor
+def get_section(data, key):
+    """Returns a schema section as a dict, even if the model sent null or a bare string."""
+    section = data.get(key)
+    return section if isinstance(section, dict) else {}
+
+def get_score(risk):
+    """Coerces the overall risk score to an int in 0-100 (the model may send "72", 72.5, "85/100" or null)."""
+    value = risk.get('score', 0)
+    if isinstance(value, str): value = value.split('/')[0].strip()
+    try: return max(0, min(100, int(float(value))))
+    except (TypeError, ValueError, OverflowError): return 0 # OverflowError: "1e999" / Infinity
+
+def format_value(value):
+    """Display text for a commercial field; null or empty becomes 'N/A'."""
+    if value is None or value == "": return "N/A"
+    return value if isinstance(value, str) else str(value)
+
+RISK_AREAS = ("Liability & Indemnity", "HSE & Operational", "Termination & Exit", "Compliance & Governance")
+
+def normalize_analysis(data):
+    """Coerces a raw model result into the schema shape once at ingest, so reruns only do plain lookups."""
+    for key in ('contractDetails', 'overallRisk', 'keyCommercials', 'riskMatrix', 'scope'):
+        data[key] = get_section(data, key)
+    
+    details = data['contractDetails']
+    parties = details.get('parties')
+    details['parties'] = [str(p) for p in parties] if isinstance(parties, list) else []
+    
+    data['overallRisk']['score'] = get_score(data['overallRisk'])
+    
+    comm = data['keyCommercials']
+    for field in ('value', 'duration', 'contractType'):
+        comm[field] = format_value(comm.get(field))
+    
+    summary = data.get('executiveSummary')
+    data['executiveSummary'] = [str(item) for item in summary] if isinstance(summary, list) else []
+    
+    matrix = data['riskMatrix']
+    for area in RISK_AREAS:
+        matrix[area] = get_section(matrix, area)
+    return data
+
 # ==========================================
 # 📄 STYLISH PDF ENGINE (v1.0 Identity)
 # ==========================================
+# Core fonts use WinAnsi encoding: typographic characters the model loves map onto their
+# cp1252 slots (0x80-0x9F) so they print as real glyphs instead of '?'
+_PDF_CHAR_MAP = str.maketrans({
+    '\u2018': '\x91', '\u2019': '\x92', '\u201c': '\x93', '\u201d': '\x94',
+    '\u2022': '\x95', '\u2013': '\x96', '\u2014': '\x97', '\u2026': '\x85',
+    '\u20ac': '\x80', '\u2122': '\x99', '\u2011': '-', '\u2212': '-',
+    '\u2192': '->', '\u2264': '<=', '\u2265': '>=',
+})
+
+def latin1(text):
+    """Core PDF fonts are latin-1 only; unmappable characters become '?' instead of crashing output()."""
+    return str(text).translate(_PDF_CHAR_MAP).encode('latin-1', 'replace').decode('latin-1')
+
 class StrategicReport(FPDF):
     def header(self):
         # 1. Brand Colors
@@ -149,9 +225,9 @@ def generate_pdf(data):
     pdf.set_auto_page_break(auto=True, margin=15)
 
     # 1. Title Section
-    details = data.get('contractDetails', {})
-    risk = data.get('overallRisk', {})
-    comm = data.get('keyCommercials', {})
+    details = data['contractDetails']
+    risk = data['overallRisk']
+    comm = data['keyCommercials']
     
     pdf.set_font('Arial', 'B', 24)
     pdf.set_text_color(30, 30, 30)
@@ -160,7 +236,7 @@ def generate_pdf(data):
     
     pdf.set_font('Arial', 'B', 12)
     pdf.set_text_color(100, 100, 100)
-    pdf.multi_cell(0, 8, str(details.get('title', 'Contract Analysis')), 0, 'L')
+    pdf.multi_cell(0, 8, latin1(details.get('title', 'Contract Analysis')), 0, 'L')
     pdf.ln(10)
 
     # 2. The Verdict Box (Style Guide v1.0)
@@ -175,8 +251,8 @@ def generate_pdf(data):
     # Verdict Title
     pdf.set_font('Arial', 'B', 12)
     pdf.set_text_color(0, 51, 102) # Navy
-    score = risk.get('score', 0)
-    level = risk.get('level', 'N/A').upper()
+    score = risk['score']
+    level = latin1(risk.get('level', 'N/A')).upper()
     pdf.cell(0, 8, f"STRATEGIC VERDICT: {level} RISK ({score}/100)", 0, 1)
     
     # Executive Summary Bullets
@@ -185,11 +261,11 @@ def generate_pdf(data):
     pdf.set_x(15)
     
     summary_text = ""
-    for item in data.get('executiveSummary', []):
+    for item in data['executiveSummary']:
         clean_item = item.replace('**', '').replace('-', '').strip()
         summary_text += "- " + clean_item + "\n"
     
-    pdf.multi_cell(180, 6, summary_text)
+    pdf.multi_cell(180, 6, latin1(summary_text))
     pdf.ln(25)
 
     # 3. Commercial Snapshot
@@ -202,74 +278,154 @@ def generate_pdf(data):
     # Col 1: Type
     pdf.cell(60, 8, "Contract Type:", 0, 0)
     pdf.set_font('Arial', '', 11)
-    pdf.cell(0, 8, str(comm.get('contractType')), 0, 1)
+    pdf.cell(0, 8, latin1(comm['contractType']), 0, 1)
     
     # Col 2: Value
     pdf.set_font('Arial', 'B', 11)
     pdf.cell(60, 8, "Value Structure:", 0, 0)
     pdf.set_font('Arial', '', 11)
-    pdf.cell(0, 8, str(comm.get('value')), 0, 1)
+    pdf.cell(0, 8, latin1(comm['value']), 0, 1)
     
     # Col 3: Duration
     pdf.set_font('Arial', 'B', 11)
     pdf.cell(60, 8, "Duration:", 0, 0)
     pdf.set_font('Arial', '', 11)
-    pdf.cell(0, 8, str(comm.get('duration')), 0, 1)
+    pdf.cell(0, 8, latin1(comm['duration']), 0, 1)
     pdf.ln(10)
 
     # 4. Detailed Analysis Body
-    report_body = data.get('detailedAnalysis', "No detailed analysis generated.")
-    pdf.chapter_body(report_body)
+    report_body = data.get('detailedAnalysis') or "No detailed analysis generated."
+    pdf.chapter_body(latin1(report_body))
+
+    # Classic FPDF returns a latin-1 str (inputs are pre-sanitized, so no 'replace' scan); fpdf2 returns bytes already
+    out = pdf.output(dest='S')
+    return bytes(out) if isinstance(out, (bytes, bytearray)) else out.encode('latin-1')
 
-    return pdf.output(dest='S').encode('latin-1', 'replace')
+@st.cache_data(max_entries=8, show_spinner=False)
+def build_pdf_report(data_json):
+    # Keyed on the serialized analysis (sorted-key bytes), so reruns for the same result skip the FPDF build
+    return generate_pdf(json_loads(data_json))
 
 # ==========================================
 # 🛠️ UTILITIES
 # ==========================================
-def check_gumroad_license(key):
-    if not key: return False, "Enter Key"
+@st.cache_resource
+def get_http_session():
+    # One keep-alive pool per process (module globals are rebuilt on every rerun)
+    session = requests.Session()
+    session.headers.update({"User-Agent": "ContractIntelligence/1.0"})
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    return session
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def _verify_license(key):
+    # Raises on network failure, so connection errors are never cached
     url = "https://api.gumroad.com/v2/licenses/verify"
     params = {"product_id": GUMROAD_PRODUCT_ID, "license_key": key, "increment_uses_count": "false"}
-    try:
-        response = requests.post(url, data=params)
-        data = response.json()
-        if data.get("success") and not data.get("purchase", {}).get("refunded"): return True, "Valid"
-        return False, "Invalid Key"
-    except: return False, "Connection Error"
+    data = get_http_session().post(url, data=params, timeout=4).json()
+    if data.get("success") and not data.get("purchase", {}).get("refunded"): return True, "Valid"
+    return False, "Invalid Key"
+
+def check_gumroad_license(key):
+    if not key: return False, "Enter Key"
+    try: return _verify_license(key)
+    except (requests.RequestException, ValueError): return False, "Connection Error" # Network failure or non-JSON reply
 
 def log_to_discord(message):
     if DISCORD_WEBHOOK:
-        try: requests.post(DISCORD_WEBHOOK, json={"content": message})
-        except: pass
-
-def extract_text(file_obj):
+        try: get_http_session().post(DISCORD_WEBHOOK, json={"content": message}, timeout=2)
+        except requests.RequestException as e: logging.warning("Discord webhook failed: %s", e)
+
+# Gemini 2.5 has a large context, reading up to 120 pages safely
+MAX_PAGES = 120
+# Budget the contract in tokens (what Gemini bills and limits on); ~4 chars/token holds for English legal text
+MAX_INPUT_TOKENS = 37500
+CHARS_PER_TOKEN = 4
+MAX_CHARS = MAX_INPUT_TOKENS * CHARS_PER_TOKEN
+# Content streams above this are engineering drawings / P&IDs: megabytes of path operators, almost no text
+MAX_CONTENT_BYTES = 1_000_000
+
+def _extract_pdftotext(exe, file_bytes):
+    # Poppler's native extractor reads the upload from stdin; None hands over to the Python parsers
+    try:
+        proc = subprocess.run([exe, "-q", "-enc", "UTF-8", "-l", str(MAX_PAGES), "-", "-"],
+                              input=file_bytes, capture_output=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if proc.returncode != 0: return None
+    text = proc.stdout.decode('utf-8', 'replace').replace('\f', '\n')[:MAX_CHARS] # \f = page break
+    return text if text.strip() else None # Blank output (e.g. no text layer): let the fallbacks try
+
+def _extract_pymupdf(fitz, file_bytes):
+    # MuPDF parses in C and skips most drawing operators: several times faster than PyPDF2
+    parts, running, skipped = [], 0, 0
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        for i in range(min(doc.page_count, MAX_PAGES)):
+            page = doc.load_page(i)
+            if len(page.read_contents()) > MAX_CONTENT_BYTES:
+                skipped += 1
+                continue
+            chunk = page.get_text("text")
+            parts.append(chunk)
+            running += len(chunk)
+            if running >= MAX_CHARS: break # Later pages would be truncated away anyway
+    return "\n".join(parts)[:MAX_CHARS], skipped
+
+def _stream_length(stream):
+    # PyPDF2's parser drops /Length from the stream dict, keeping the still-encoded bytes in _data
+    if '/Length' in stream: return int(stream['/Length'])
+    return len(stream._data)
+
+def _raw_content_length(page):
+    # /Contents may be one stream or an array of them; sum their encoded sizes without decoding.
+    # Encoded sizes run below MuPDF's decoded ones, so this only skips the very heaviest pages.
+    try:
+        if '/Contents' not in page: return 0
+        contents = page['/Contents']
+        streams = contents if isinstance(contents, list) else [contents]
+        return sum(_stream_length(s.get_object()) for s in streams)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return 0 # Odd /Contents: extract the page rather than drop the whole document
+
+def _extract_pypdf2(file_bytes):
+    import PyPDF2 # Fallback when PyMuPDF isn't installed
+    reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
+    parts, running, skipped = [], 0, 0
+    for i in range(min(len(reader.pages), MAX_PAGES)): 
+        page = reader.pages[i]
+        if _raw_content_length(page) > MAX_CONTENT_BYTES:
+            skipped += 1
+            continue
+        chunk = page.extract_text()
+        if not chunk: continue
+        parts.append(chunk)
+        running += len(chunk)
+        if running >= MAX_CHARS: break
+    return "\n".join(parts)[:MAX_CHARS], skipped
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def extract_text(file_bytes):
+    """(text, drawing pages skipped); text is None if the PDF could not be read."""
+    # Cached on the raw upload bytes: re-running the same PDF skips the parse
+    exe = shutil.which("pdftotext")
+    text = _extract_pdftotext(exe, file_bytes) if exe else None
+    if text: return text, 0 # Poppler has no per-page size filter: nothing skipped
     try:
-        reader = PyPDF2.PdfReader(file_obj)
-        text = ""
-        # 1.5 Pro has large context, reading up to 120 pages safely
-        for i in range(min(len(reader.pages), 120)): 
-            text += reader.pages[i].extract_text() + "\n"
-        return text
-    except: return None
+        import fitz # Only needed once a file is uploaded
+    except ImportError:
+        fitz = None
+    try:
+        return _extract_pymupdf(fitz, file_bytes) if fitz else _extract_pypdf2(file_bytes)
+    except Exception: return None, 0 # Corrupt or encrypted PDF: each parser raises its own error types
 
 # ==========================================
-# 🧠 ANALYSIS ENGINE (Gemini 2.5 Pro)
+# 🧠 ANALYSIS ENGINE (Gemini 2.5)
 # ==========================================
-def run_analysis(text, contract_type, perspective):
-    genai.configure(api_key=API_KEY)
-    model = genai.GenerativeModel(ACTIVE_MODEL)
-    
-    # Context Injection
-    specific_focus = CONTRACT_DEFINITIONS.get(contract_type, "General Commercial Analysis")
-    
-    # The Senior Strategist Prompt
-    base_instruction = f"""
+
+# The Senior Strategist Prompt (static - built once at load, only the context header varies per call)
+_PROMPT_TEMPLATE = """
     YOU ARE A SENIOR LEGAL STRATEGIST AND PROCUREMENT MANAGER.
     
-    **CONTEXT:**
-    - **Contract Type:** {contract_type} ({specific_focus})
-    - **Perspective:** You are acting for the **{perspective}**. Protect their interests aggressively.
-    
     **TASK:** Analyze the provided contract and extract structured data for a management dashboard and a detailed written report.
 
     **STYLE GUIDE (McKinsey Style):**
@@ -281,7 +437,7 @@ def run_analysis(text, contract_type, perspective):
 
     1. **Structured Data Fields**:
        - **contractDetails**: Official title and parties.
-       - **overallRisk**: 'High'/'Medium'/'Low' based on {perspective}'s risk exposure.
+       - **overallRisk**: 'High'/'Medium'/'Low' based on the represented party's risk exposure.
        - **keyCommercials**: Value, duration, type.
        - **executiveSummary**: 3-5 high-impact bullet points. Use Markdown. Focus on Bottom Line Up Front.
        - **riskMatrix**: Analyze Liability, HSE, Termination, Compliance.
@@ -297,43 +453,330 @@ def run_analysis(text, contract_type, perspective):
          - ## HSE, Operational and Performance Risk
          - ## Term, Termination, Breach and Force Majeure
          - ## Legal, Compliance and Governance
-         - ## Strategic Recommendations (Tailored for the {perspective})
+         - ## Strategic Recommendations (Tailored for the [Perspective]) -- use the exact heading given in CONTEXT
     
     OUTPUT SCHEMA:
-    {SCHEMA_DEF}
+    {schema}
+    """
+MASTER_PROMPT = _PROMPT_TEMPLATE.format(schema=SCHEMA_DEF)
+
+_CONTEXT_TEMPLATE = """
+    **CONTEXT:**
+    - **Contract Type:** {contract_type} ({focus})
+    - **Perspective:** You are acting for the **{perspective}**. Protect their interests aggressively.
+    - **Detailed Report:** {report_scope}
+    - **Recommendations Heading:** ## Strategic Recommendations (Tailored for the {perspective})
     
     CONTRACT TEXT:
-    {text[:150000]}
     """
+
+# The deep-dive is the bulk of the generated tokens, so skipping it is the biggest latency lever
+REPORT_SCOPE = {
+    True: "Write the full detailedAnalysis deep-dive.",
+    False: "Skip the deep-dive. Return an empty string for detailedAnalysis.",
+}
+
+# Fingerprint of everything sent to the model besides the contract: any wording change invalidates cached analyses
+PROMPT_VERSION = hashlib.blake2b(
+    json.dumps([MASTER_PROMPT, _CONTEXT_TEMPLATE, CONTRACT_DEFINITIONS, REPORT_SCOPE[True], REPORT_SCOPE[False]], sort_keys=True).encode('utf-8'),
+    digest_size=8).hexdigest()
+
+_RE_JSON_OBJ = re.compile(r"\{.*\}", re.DOTALL)
+
+_CLOSERS = {'{': '}', '[': ']'}
+
+def close_open_brackets(text):
+    """Closes a truncated JSON document in one pass (string-aware, so braces inside values are ignored)."""
+    stack, in_str, esc = [], False, False
+    for ch in text:
+        if in_str:
+            if esc: esc = False
+            elif ch == '\\': esc = True
+            elif ch == '"': in_str = False
+        elif ch == '"': in_str = True
+        elif ch in _CLOSERS: stack.append(_CLOSERS[ch])
+        elif ch in ('}', ']') and stack: stack.pop()
+    if in_str: text += '"'
+    return text.rstrip().rstrip(',') + ''.join(reversed(stack))
+
+def parse_json_response(text):
+    """(data, repaired): JSON-mode replies parse directly; fenced or chatty replies fall back to the outermost {...} span.
+    repaired is True when a truncated reply had to be closed, i.e. the analysis is partial."""
+    text = text.strip()
+    if text.startswith('{'):
+        try: return json_loads(text), False
+        except json.JSONDecodeError: pass
+    match = _RE_JSON_OBJ.search(text)
+    if match:
+        try: return json_loads(match.group(0)), False
+        except json.JSONDecodeError: pass
+    # Last resort: the reply was cut off mid-object (e.g. output token limit)
+    start = text.find('{')
+    if start < 0: raise ValueError("Model response contained no JSON object")
+    return json_loads(close_open_brackets(text[start:])), True
+
+@st.cache_resource
+def get_model(model_name):
+    # Configured once per process and shared across sessions (the wrapper is not serializable).
+    # Imported here so cold starts and the login screen don't pay for grpc/protobuf.
+    import google.generativeai as genai
+    genai.configure(api_key=API_KEY)
+    # Static instructions + schema as the system prompt: an identical prefix on every call is eligible for Gemini's implicit context caching
+    return genai.GenerativeModel(model_name, system_instruction=MASTER_PROMPT)
+
+# Bounds per call. 2.5 models count thinking tokens against the output cap, so it is sized
+# well above the JSON + deep-dive (~10k tokens) to avoid truncating the reply.
+MAX_OUTPUT_TOKENS = 32768
+# Whole streamed call, in seconds, sized so a full MAX_OUTPUT_TOKENS reply can finish (Pro generates far slower than Flash);
+# a stalled connection must not pin the Streamlit worker, and a timeout is not retried (the same request would time out again)
+REQUEST_TIMEOUT = {"flash": 300, "pro": 600}
+RETRY_BUDGET = 600 # seconds since the first attempt after which no retry is started
+
+def request_timeout(model_name):
+    return REQUEST_TIMEOUT["pro" if "pro" in model_name else "flash"]
+
+# Client-side quota guard (Google AI defaults; override per billing tier)
+def env_int(name, default):
+    """Positive int from the environment; a malformed value falls back to the default, anything below 1 is clamped."""
+    try: return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        logging.warning("Ignoring non-integer %s=%r, using %s", name, os.environ.get(name), default)
+        return default
+
+RPM_LIMIT = env_int("GEMINI_RPM", 60)
+TPM_LIMIT = env_int("GEMINI_TPM", 100000)
+
+class RateLimiter:
+    """Sliding 60s window over request and token budgets, shared by every session in the process."""
+    def __init__(self, rpm, tpm):
+        self.rpm, self.tpm = rpm, tpm
+        self.calls = deque() # (monotonic timestamp, estimated tokens)
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.tpm) # A single oversized request must not wait forever
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0][0] >= 60: self.calls.popleft()
+                used = sum(t for _, t in self.calls)
+                if len(self.calls) < self.rpm and used + tokens <= self.tpm:
+                    self.calls.append((now, tokens))
+                    return
+                wait = 60 - (now - self.calls[0][0])
+            time.sleep(wait)
+
+@st.cache_resource
+def get_rate_limiter():
+    return RateLimiter(RPM_LIMIT, TPM_LIMIT)
+
+def _stream_text(model, contents, on_progress=None):
+    # Streamed: the SDK hands back chunks as they are generated instead of one blocking reply
+    response = model.generate_content(
+        contents,
+        generation_config={"response_mime_type": "application/json", "max_output_tokens": MAX_OUTPUT_TOKENS},
+        request_options={"timeout": request_timeout(model.model_name)},
+        stream=True,
+    )
+    chunks, received = [], 0
+    for chunk in response:
+        if not chunk.parts: continue
+        chunks.append(chunk.text)
+        received += len(chunk.text)
+        if on_progress: on_progress(received)
+    return "".join(chunks)
+
+def _server_retry_delay(error):
+    """Seconds from a google.rpc.RetryInfo detail on a 429 (gRPC message or REST dict), else 0."""
+    for detail in getattr(error, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None: return delay.seconds + delay.nanos / 1e9
+        if isinstance(detail, dict) and 'retryDelay' in detail:
+            try: return float(str(detail['retryDelay']).rstrip('s'))
+            except ValueError: pass
+    return 0
+
+MAX_RETRY_WAIT = 60 # seconds; a longer server cooldown (e.g. daily quota) fails fast instead of hanging behind a spinner
+
+def generate_with_retry(model, contents, on_progress=None, max_retries=5, base_delay=2):
+    """Retries rate-limit / transient server errors with jittered exponential backoff; anything else raises."""
+    from google.api_core import exceptions
+    transient = (exceptions.ResourceExhausted, exceptions.InternalServerError, exceptions.BadGateway,
+                 exceptions.ServiceUnavailable, exceptions.GatewayTimeout)
+    started = time.monotonic()
+    for attempt in range(max_retries):
+        try:
+            return _stream_text(model, contents, on_progress)
+        except transient as e:
+            if attempt == max_retries - 1: raise
+            hint = _server_retry_delay(e)
+            if hint > MAX_RETRY_WAIT:
+                raise RuntimeError(f"Gemini quota exhausted (server asked to retry in {hint:.0f}s). Please try again later.") from e
+            # Jitter keeps concurrent sessions from retrying in lockstep; a server cooldown hint wins if longer
+            backoff = min(base_delay * 2 ** attempt + random.uniform(0, 1), MAX_RETRY_WAIT)
+            wait = max(backoff, hint)
+            if time.monotonic() - started + wait > RETRY_BUDGET: raise
+            time.sleep(wait)
+
+# Optional on-disk result store (set ANALYSIS_CACHE_DB to a file path): repeat uploads survive restarts and redeploys.
+# Off by default because it writes contract analyses to disk unencrypted (the reason persist="disk" was rejected);
+# enabling it is the operator's call, e.g. on an encrypted volume the app alone can read.
+ANALYSIS_CACHE_DB = os.environ.get("ANALYSIS_CACHE_DB")
+# Rows older than this (seconds, default 7 days) are never served and are pruned on each write
+ANALYSIS_CACHE_TTL = env_int("ANALYSIS_CACHE_TTL", 604800)
+
+@st.cache_resource
+def _init_result_store(path):
+    with closing(sqlite3.connect(path)) as conn, conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS analyses (key TEXT PRIMARY KEY, result BLOB, ts INTEGER)")
+        conn.execute("CREATE INDEX IF NOT EXISTS analyses_ts ON analyses (ts)")
+        conn.execute("DELETE FROM analyses WHERE ts < ?", (int(time.time()) - ANALYSIS_CACHE_TTL,))
+    return path
+
+def _store_get(key):
+    if not ANALYSIS_CACHE_DB: return None
+    try:
+        with closing(sqlite3.connect(_init_result_store(ANALYSIS_CACHE_DB))) as conn:
+            row = conn.execute("SELECT result FROM analyses WHERE key = ? AND ts >= ?",
+                               (key, int(time.time()) - ANALYSIS_CACHE_TTL)).fetchone()
+        return json_loads(zlib.decompress(row[0])) if row else None
+    except (sqlite3.Error, zlib.error, ValueError) as e:
+        logging.warning("Result store read failed: %s", e)
+        return None
+
+def _store_put(key, result):
+    if not ANALYSIS_CACHE_DB: return
+    try:
+        blob = zlib.compress(json_dumps(result)) # Report prose and repeated keys compress well
+        with closing(sqlite3.connect(_init_result_store(ANALYSIS_CACHE_DB))) as conn, conn:
+            now = int(time.time())
+            conn.execute("DELETE FROM analyses WHERE ts < ?", (now - ANALYSIS_CACHE_TTL,))
+            conn.execute("INSERT OR REPLACE INTO analyses VALUES (?, ?, ?)", (key, blob, now))
+    except sqlite3.Error as e:
+        logging.warning("Result store write failed: %s", e)
+
+class ResultCache:
+    """Process-wide TTL/LRU map of finished analyses (stored serialized, so every hit is a fresh copy)."""
+    def __init__(self, max_entries=32, ttl=3600):
+        self.max_entries, self.ttl = max_entries, ttl
+        self.items = OrderedDict() # key -> (monotonic timestamp, JSON bytes)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None: return None
+            if time.monotonic() - entry[0] >= self.ttl:
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+        return json_loads(entry[1])
+
+    def put(self, key, result):
+        blob = json_dumps(result)
+        with self.lock:
+            self.items[key] = (time.monotonic(), blob)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_entries: self.items.popitem(last=False)
+
+@st.cache_resource
+def get_result_cache():
+    # Not st.cache_data: the streaming progress callback draws UI, which st.cache_data would record and fail to replay on a hit
+    return ResultCache()
+
+def _analyze(contract_type, perspective, model_name, detailed, text, on_progress=None):
+    model = get_model(model_name)
+    
+    # Context Injection
+    specific_focus = CONTRACT_DEFINITIONS.get(contract_type, "General Commercial Analysis")
     
+    header = _CONTEXT_TEMPLATE.format(contract_type=contract_type, focus=specific_focus, perspective=perspective,
+                                      report_scope=REPORT_SCOPE[detailed])
+    # Header and contract go as separate parts of one turn: the (up to 150k-char) text is never copied into a new string
+    contents = [header, text[:MAX_CHARS]]
+    
+    # Wait locally for quota rather than burning a round-trip on a 429 (~4 chars/token + schema/instructions)
+    get_rate_limiter().acquire(sum(map(len, contents)) // CHARS_PER_TOKEN + 2000)
+    return parse_json_response(generate_with_retry(model, contents, on_progress))
+
+def run_analysis(text, contract_type, perspective, model_name=ACTIVE_MODEL, detailed=True, on_progress=None):
+    """The analysis dict, {"error": ...} on failure; a repaired (truncated) reply carries "_partial": True."""
+    # Keyed on the content digest plus everything that shapes the reply; PROMPT_VERSION means a
+    # prompt/schema change never serves a stale result. Failures raise, so errors are never cached.
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+    key = "|".join((digest, PROMPT_VERSION, contract_type, perspective, model_name, str(detailed)))
+    cache = get_result_cache()
     try:
-        response = model.generate_content(base_instruction, generation_config={"response_mime_type": "application/json"})
-        return json.loads(response.text)
+        result = cache.get(key)
+        if result is not None: return result
+        result = _store_get(key)
+        if result is None:
+            result, repaired = _analyze(contract_type, perspective, model_name, detailed, text, on_progress)
+            # A truncated reply is shown once with a warning but never cached: the next run gets a full attempt
+            if repaired:
+                result['_partial'] = True
+                return result
+            _store_put(key, result)
+        cache.put(key, result)
+        return result
     except Exception as e:
         return {"error": str(e)}
 
 # ==========================================
 # 🖥️ UI / DASHBOARD
 # ==========================================
+# Re-emitted on every rerun: Streamlit removes any element a rerun does not send again
+APP_CSS = """
+    <style>
+    .stApp { background-color: #ffffff; font-family: 'Helvetica Neue', sans-serif; }
+    .metric-card {
+        background-color: white; border: 1px solid #e5e7eb; border-radius: 8px;
+        padding: 20px; box-shadow: 0 1px 2px 0 rgba(0,0,0,0.05);
+        height: 100%; display: flex; flex-direction: column;
+    }
+    .metric-grid { display: grid; grid-template-columns: repeat(4, 1fr); gap: 16px; }
+    .risk-grid { display: grid; grid-template-columns: repeat(2, 1fr); grid-template-rows: repeat(2, auto); grid-auto-flow: column; column-gap: 16px; }
+    @media (max-width: 640px) {
+        .metric-grid, .risk-grid { grid-template-columns: 1fr; grid-template-rows: none; grid-auto-flow: row; }
+    }
+    .card-label { font-size: 0.75rem; color: #6b7280; text-transform: uppercase; font-weight: 700; margin-bottom: 5px; }
+    .card-value { font-size: 1.25rem; font-weight: 700; color: #111827; }
+    .risk-badge { padding: 4px 10px; border-radius: 12px; font-size: 0.75rem; font-weight: 700; text-transform: uppercase; display: inline-block; }
+    .bg-high { background-color: #fef2f2; color: #991b1b; border: 1px solid #fecaca; }
+    .bg-med { background-color: #fffbeb; color: #92400e; border: 1px solid #fde68a; }
+    .bg-low { background-color: #ecfdf5; color: #065f46; border: 1px solid #a7f3d0; }
+    </style>
+"""
+
+# Overall risk + three commercial cards, filled per render with one str.format
+METRIC_ROW_TEMPLATE = (
+    '<div class="metric-grid">'
+    '<div class="metric-card"><div class="card-label">Overall Risk</div>'
+    '<div><span class="risk-badge {bg_cls}">{level}</span> <span style="font-size:1.2rem; font-weight:700;">{score}/100</span></div>'
+    '<div style="font-size:0.8rem; color:#666; margin-top:5px;">{rationale}</div></div>'
+    '<div class="metric-card"><div class="card-label">Contract Value</div><div class="card-value">{value}</div></div>'
+    '<div class="metric-card"><div class="card-label">Duration</div><div class="card-value" style="font-size:1rem;">{duration}</div></div>'
+    '<div class="metric-card"><div class="card-label">Type</div><div class="card-value">{contract_type}</div></div>'
+    '</div>'
+)
+
+# Risk level -> badge class (the matrix schema uses "Med", the overall score uses "Medium")
+RISK_BADGE_CLASS = {"High": "bg-high", "Medium": "bg-med", "Med": "bg-med"}
+
+def render_risk_box(title, obj):
+    l = obj.get('level', 'Low')
+    b = RISK_BADGE_CLASS.get(l, "bg-low")
+    return (
+        f'<div class="metric-card" style="margin-bottom:20px;">'
+        f'<div style="display:flex; justify-content:space-between;">'
+        f'<span style="font-weight:700;">{title}</span><span class="risk-badge {b}">{l}</span></div>'
+        f'<p style="font-size:0.9rem; margin-top:10px;">{obj.get("summary")}</p></div>'
+    )
+
 def main():
     
     # --- UI STYLING ---
-    st.markdown("""
-        <style>
-        .stApp { background-color: #ffffff; font-family: 'Helvetica Neue', sans-serif; }
-        .metric-card {
-            background-color: white; border: 1px solid #e5e7eb; border-radius: 8px;
-            padding: 20px; box-shadow: 0 1px 2px 0 rgba(0,0,0,0.05);
-            height: 100%; display: flex; flex-direction: column;
-        }
-        .card-label { font-size: 0.75rem; color: #6b7280; text-transform: uppercase; font-weight: 700; margin-bottom: 5px; }
-        .card-value { font-size: 1.25rem; font-weight: 700; color: #111827; }
-        .risk-badge { padding: 4px 10px; border-radius: 12px; font-size: 0.75rem; font-weight: 700; text-transform: uppercase; display: inline-block; }
-        .bg-high { background-color: #fef2f2; color: #991b1b; border: 1px solid #fecaca; }
-        .bg-med { background-color: #fffbeb; color: #92400e; border: 1px solid #fde68a; }
-        .bg-low { background-color: #ecfdf5; color: #065f46; border: 1px solid #a7f3d0; }
-        </style>
-    """, unsafe_allow_html=True)
+    st.markdown(APP_CSS, unsafe_allow_html=True)
 
     # --- SIDEBAR ---
     with st.sidebar:
@@ -346,6 +789,7 @@ def main():
                 valid, msg = check_gumroad_license(key)
                 if valid:
                     st.session_state.authenticated = True
+                    st.session_state.license_key = key
                     st.success("Access Granted")
                     st.rerun()
                 else: st.error(msg)
@@ -371,106 +815,105 @@ def main():
             help="The AI will protect the interests of the selected party."
         )
         
+        # 3. Engine
+        engine = st.selectbox(
+            "Engine",
+            ENGINE_OPTIONS,
+            help="Flash returns in a fraction of the time; choose Pro for high-risk contracts that need deeper reasoning."
+        )
+        
+        # 4. Report Depth
+        detailed = st.toggle(
+            "Include detailed report",
+            value=True,
+            help="Turn off for a faster dashboard-only review (no deep-dive section)."
+        )
+        
         st.markdown("---")
         uploaded_file = st.file_uploader("Upload Agreement (PDF)", type=["pdf"])
         
         if st.button("Logout"):
             st.session_state.authenticated = False
+            # Drop only this user's cached verification: their next login re-validates (e.g. a key refunded mid-session)
+            _verify_license.clear(st.session_state.pop('license_key', None))
             st.rerun()
 
     # --- MAIN CONTENT ---
-    c1, c2 = st.columns([3,1])
-    with c1:
-        st.markdown('### ⚙️ CONTRACT INTELLIGENCE', unsafe_allow_html=True)
-        st.caption("Strategic Analysis & Procurement Guardrails")
+    st.markdown('### ⚙️ CONTRACT INTELLIGENCE', unsafe_allow_html=True)
+    st.caption("Strategic Analysis & Procurement Guardrails")
     
     if uploaded_file:
         if st.button("🚀 Run Strategic Analysis"):
             with st.spinner("⚙️ Analyzing Commercials, Risk & Compliance..."):
-                text = extract_text(uploaded_file)
-                if text:
-                    result = run_analysis(text, c_type, perspective)
+                text, skipped = extract_text(uploaded_file.getvalue())
+                if text and text.strip():
+                    progress = st.empty()
+                    result = run_analysis(text, c_type, perspective, engine, detailed,
+                                          on_progress=lambda n: progress.caption(f"⏳ Receiving analysis... {n:,} characters"))
+                    progress.empty()
                     if "error" not in result:
-                        st.session_state.result = result
+                        st.session_state.partial = result.pop('_partial', False)
+                        st.session_state.result = normalize_analysis(result)
+                        st.session_state.skipped_pages = skipped
                         st.rerun()
                     else: st.error(f"Analysis Failed: {result['error']}")
+                elif skipped:
+                    st.error(f"No text could be extracted: {skipped} drawing-heavy page(s) (e.g. P&IDs) were skipped and the rest had no text layer.")
+                else:
+                    st.error("No text could be extracted from this PDF (it may be scanned, encrypted or corrupt).")
 
     # --- DASHBOARD RENDER ---
     if "result" in st.session_state:
         data = st.session_state.result
         
         # 1. METADATA & RISK SCORE
-        details = data.get('contractDetails', {})
-        risk = data.get('overallRisk', {})
-        comm = data.get('keyCommercials', {})
+        details = data['contractDetails']
+        risk = data['overallRisk']
+        comm = data['keyCommercials']
         
         st.markdown(f"## {details.get('title', 'Contract Assessment')} ✅")
-        st.caption(f"Parties: {', '.join(details.get('parties', []))}")
-        
-        # Metric Row
-        c1, c2, c3, c4 = st.columns(4)
+        st.caption(f"Parties: {', '.join(details['parties'])}")
+        if st.session_state.get('partial'):
+            st.warning("⚠️ The model's reply was cut off, so this analysis is partial: sections missing from it show placeholder values (not a Low-risk finding). Run the analysis again for a complete result.")
+        if st.session_state.get('skipped_pages'):
+            st.info(f"ℹ️ {st.session_state.skipped_pages} drawing-heavy page(s) (e.g. P&IDs) were skipped during text extraction and not analysed.")
         
+        # Metric Row (one grid block = one delta instead of four columns)
         lvl = risk.get('level', 'Medium')
-        bg_cls = "bg-high" if lvl == 'High' else "bg-med" if lvl == 'Medium' else "bg-low"
+        score = risk['score']
+        bg_cls = RISK_BADGE_CLASS.get(lvl, "bg-low")
         
-        with c1:
-            st.markdown(f"""
-            <div class="metric-card">
-                <div class="card-label">Overall Risk</div>
-                <div><span class="risk-badge {bg_cls}">{lvl}</span> <span style="font-size:1.2rem; font-weight:700;">{risk.get('score')}/100</span></div>
-                <div style="font-size:0.8rem; color:#666; margin-top:5px;">{risk.get('rationale')}</div>
-            </div>
-            """, unsafe_allow_html=True)
-            
-        with c2: st.markdown(f'<div class="metric-card"><div class="card-label">Contract Value</div><div class="card-value">{comm.get("value")}</div></div>', unsafe_allow_html=True)
-        with c3: st.markdown(f'<div class="metric-card"><div class="card-label">Duration</div><div class="card-value" style="font-size:1rem;">{comm.get("duration")}</div></div>', unsafe_allow_html=True)
-        with c4: st.markdown(f'<div class="metric-card"><div class="card-label">Type</div><div class="card-value">{comm.get("contractType")}</div></div>', unsafe_allow_html=True)
+        cards = METRIC_ROW_TEMPLATE.format(bg_cls=bg_cls, level=lvl, score=score, rationale=risk.get('rationale'),
+                                           value=comm['value'], duration=comm['duration'], contract_type=comm['contractType'])
+        st.markdown(cards, unsafe_allow_html=True)
 
         st.markdown("---")
 
         # 2. EXECUTIVE SUMMARY
         st.subheader("📝 Executive Synthesis")
-        for item in data.get('executiveSummary', []):
-            st.markdown(item)
-            
+        # One markdown block for all points (blank-line separated, so each still renders as its own paragraph)
+        st.markdown("\n\n".join(data['executiveSummary']))
+
         st.markdown("---")
 
         # 3. RISK MATRIX GRID
         st.subheader("🛡️ Risk & Compliance Matrix")
-        r_grid = data.get('riskMatrix', {})
-        
-        rc1, rc2 = st.columns(2)
+        r_grid = data['riskMatrix']
         
-        def render_risk_box(title, obj):
-            l = obj.get('level', 'Low')
-            b = "bg-high" if l == 'High' else "bg-med" if l == 'Medium' else "bg-low"
-            return f"""
-            <div class="metric-card" style="margin-bottom:20px;">
-                <div style="display:flex; justify-content:space-between;">
-                    <span style="font-weight:700;">{title}</span>
-                    <span class="risk-badge {b}">{l}</span>
-                </div>
-                <p style="font-size:0.9rem; margin-top:10px;">{obj.get('summary')}</p>
-            </div>
-            """
-
-        with rc1:
-            st.markdown(render_risk_box("Liability & Indemnity", r_grid.get('Liability & Indemnity', {})), unsafe_allow_html=True)
-            st.markdown(render_risk_box("HSE & Operational", r_grid.get('HSE & Operational', {})), unsafe_allow_html=True)
-            
-        with rc2:
-            st.markdown(render_risk_box("Termination & Exit", r_grid.get('Termination & Exit', {})), unsafe_allow_html=True)
-            st.markdown(render_risk_box("Compliance & Governance", r_grid.get('Compliance & Governance', {})), unsafe_allow_html=True)
+        # All four boxes in one 2x2 block (column-major, same layout as the old two st.columns)
+        boxes = "".join(render_risk_box(area, r_grid[area]) for area in RISK_AREAS)
+        st.markdown(f'<div class="risk-grid">{boxes}</div>', unsafe_allow_html=True)
 
-        # 4. DEEP DIVE REPORT
-        st.markdown("### 📋 Detailed Strategic Report")
-        with st.expander("View Full McKinsey-Style Analysis", expanded=True):
-            st.markdown(data.get('detailedAnalysis', 'Report generation failed.'))
+        # 4. DEEP DIVE REPORT (an empty string means the user opted out of it)
+        if data.get('detailedAnalysis') != "":
+            st.markdown("### 📋 Detailed Strategic Report")
+            with st.expander("View Full McKinsey-Style Analysis", expanded=True):
+                st.markdown(data.get('detailedAnalysis') or 'Report generation failed.')
 
         # 5. PDF EXPORT
         st.markdown("---")
         if st.button("📄 Download Strategic Report (PDF)"):
-            pdf_bytes = generate_pdf(data)
+            pdf_bytes = build_pdf_report(json_dumps(data))
             st.download_button("📥 Click to Download", pdf_bytes, "Strategic_Report.pdf", "application/pdf")
 
 if __name__ == "__main__":